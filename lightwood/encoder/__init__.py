@@ -1,23 +1,29 @@
 # Encoders which should always work
+from lightwood.helpers.lazy import lazy_import_hooks
 from lightwood.encoder.base import BaseEncoder
 from lightwood.encoder.datetime.datetime import DatetimeEncoder
 from lightwood.encoder.datetime.datetime_sin_normalizer import DatetimeNormalizerEncoder
-from lightwood.encoder.image.img_2_vec import Img2VecEncoder
 from lightwood.encoder.numeric.numeric import NumericEncoder
 from lightwood.encoder.numeric.ts_numeric import TsNumericEncoder
 from lightwood.encoder.array.ts_num_array import TsArrayNumericEncoder
-from lightwood.encoder.text.short import ShortTextEncoder
 from lightwood.encoder.text.vocab import VocabularyEncoder
 from lightwood.encoder.text.rnn import RnnEncoder as TextRnnEncoder
 from lightwood.encoder.categorical.onehot import OneHotEncoder
 from lightwood.encoder.categorical.binary import BinaryEncoder
-from lightwood.encoder.categorical.autoencoder import CategoricalAutoEncoder
 from lightwood.encoder.time_series.ts import TimeSeriesEncoder
 from lightwood.encoder.array.array import ArrayEncoder, NumArrayEncoder, CatArrayEncoder
 from lightwood.encoder.categorical.multihot import MultiHotEncoder
 from lightwood.encoder.array.ts_cat_array import TsCatArrayEncoder
-from lightwood.encoder.text.pretrained import PretrainedLangEncoder
-from lightwood.encoder.audio import MFCCEncoder
+
+# Encoders with heavyweight dependencies (torchvision, transformers, librosa, mixer helpers)
+# are imported on first access
+__getattr__, __dir__ = lazy_import_hooks(__name__, {
+    'Img2VecEncoder': ('lightwood.encoder.image.img_2_vec', 'Img2VecEncoder'),
+    'ShortTextEncoder': ('lightwood.encoder.text.short', 'ShortTextEncoder'),
+    'CategoricalAutoEncoder': ('lightwood.encoder.categorical.autoencoder', 'CategoricalAutoEncoder'),
+    'PretrainedLangEncoder': ('lightwood.encoder.text.pretrained', 'PretrainedLangEncoder'),
+    'MFCCEncoder': ('lightwood.encoder.audio', 'MFCCEncoder'),
+})
 
 
 __all__ = ['BaseEncoder', 'DatetimeEncoder', 'Img2VecEncoder', 'NumericEncoder', 'TsNumericEncoder',
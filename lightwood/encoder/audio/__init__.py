@@ -1,7 +1,10 @@
+from lightwood.helpers.log import log
+
 # This encoder is optional since it's underlying dependency (librosa) needs system dependencies
 try:
     from lightwood.encoder.audio.mfcc import MFCCEncoder
-except Exception:
+except (ImportError, OSError) as e:  # OSError is raised when librosa's system libraries (e.g. libsndfile) are missing
     MFCCEncoder = None
+    log.debug(f'MFCCEncoder is not available: {e}')
 
 __all__ = ['MFCCEncoder']
@@ -1,5 +1,11 @@
+from lightwood.helpers.lazy import lazy_import_hooks
 from lightwood.encoder.categorical.onehot import OneHotEncoder
 from lightwood.encoder.categorical.multihot import MultiHotEncoder
-from lightwood.encoder.categorical.autoencoder import CategoricalAutoEncoder
+
+# imported on first access, as it pulls in the mixer helpers (and with them, every mixer dependency)
+__getattr__, __dir__ = lazy_import_hooks(__name__, {
+    'CategoricalAutoEncoder': ('lightwood.encoder.categorical.autoencoder', 'CategoricalAutoEncoder'),
+})
+
 
 __all__ = ['OneHotEncoder', 'MultiHotEncoder', 'CategoricalAutoEncoder']
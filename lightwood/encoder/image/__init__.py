@@ -1,6 +1,9 @@
+from lightwood.helpers.log import log
+
 try:
     from lightwood.encoder.image.img_2_vec import Img2VecEncoder
-except Exception:
+except ImportError as e:
     Img2VecEncoder = None
+    log.debug(f'Img2VecEncoder is not available: {e}')
 
 __all__ = ['Img2VecEncoder']
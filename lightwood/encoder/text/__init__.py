@@ -1,8 +1,13 @@
-from lightwood.encoder.text.pretrained import PretrainedLangEncoder
+from lightwood.helpers.lazy import lazy_import_hooks
 from lightwood.encoder.text.rnn import RnnEncoder
 from lightwood.encoder.text.tfidf import TfidfEncoder
-from lightwood.encoder.text.short import ShortTextEncoder
 from lightwood.encoder.text.vocab import VocabularyEncoder
 
+# imported on first access, as they pull in `transformers` and the categorical autoencoder, respectively
+__getattr__, __dir__ = lazy_import_hooks(__name__, {
+    'PretrainedLangEncoder': ('lightwood.encoder.text.pretrained', 'PretrainedLangEncoder'),
+    'ShortTextEncoder': ('lightwood.encoder.text.short', 'ShortTextEncoder'),
+})
+
 
 __all__ = ['PretrainedLangEncoder', 'RnnEncoder', 'TfidfEncoder', 'ShortTextEncoder', 'VocabularyEncoder']
@@ -0,0 +1,25 @@
+import sys
+import importlib
+from typing import Callable, Dict, Tuple
+
+
+def lazy_import_hooks(module_name: str, lazy_objects: Dict[str, Tuple[str, str]]) -> Tuple[Callable, Callable]:
+    """
+    Builds the module-level `__getattr__` and `__dir__` (PEP 562) of a module that imports the objects in `lazy_objects` on first access. Imported objects are cached in the module, so the hook only runs once per object.
+
+    :param module_name: `__name__` of the module that exports the objects.
+    :param lazy_objects: maps each exported name to the module and attribute it is imported from.
+    :return: the `__getattr__` and `__dir__` functions for the module.
+    """  # noqa
+    def __getattr__(name):
+        if name not in lazy_objects:
+            raise AttributeError(f"module {module_name!r} has no attribute {name!r}")
+        source_module, attribute = lazy_objects[name]
+        obj = getattr(importlib.import_module(source_module), attribute)
+        setattr(sys.modules[module_name], name, obj)
+        return obj
+
+    def __dir__():
+        return sorted(set(vars(sys.modules[module_name])) | set(lazy_objects))
+
+    return __getattr__, __dir__
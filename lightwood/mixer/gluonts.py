@@ -1,12 +1,15 @@
+import os
 import importlib
-from copy import deepcopy
-from typing import Dict, Union, Optional
+from random import randint
+from typing import Dict, List, Tuple, Union, Optional
 
 import numpy as np
 import pandas as pd
 import mxnet as mx
+from pandas.tseries.frequencies import to_offset
 
 from gluonts.dataset.pandas import PandasDataset
+from gluonts.dataset.common import ListDataset
 
 from gluonts.model.deepar import DeepAREstimator  # @TODO: support for other estimators
 from gluonts.mx import Trainer
@@ -18,6 +21,9 @@ from lightwood.mixer.base import BaseMixer
 from lightwood.api.types import PredictionArguments
 from lightwood.data.encoded_ds import EncodedDs, ConcatedEncodedDs
 
+# numpy 1.22 renamed the `interpolation` argument of `np.quantile` to `method`, deprecating the old name
+_QUANTILE_KWARG = 'method' if tuple(int(v) for v in np.__version__.split('.')[:2]) >= (1, 22) else 'interpolation'
+
 
 class GluonTSMixer(BaseMixer):
     horizon: int
@@ -36,6 +42,8 @@ class GluonTSMixer(BaseMixer):
             early_stop_patience: int = 3,
             distribution_output: str = '',
             seed: int = 0,
+            batch_size: int = 32,
+            ctx: str = '',
     ):
         """
         Wrapper around GluonTS probabilistic deep learning models. For now, only DeepAR is supported.
@@ -50,6 +58,8 @@ class GluonTSMixer(BaseMixer):
         :param early_stop_patience: amount of consecutive epochs with no improvement in the validation loss.
         :param distribution_output: specify the type of distribution the model will learn.
         :param seed: specifies the seed used internally by GluonTS for reproducible predictions
+        :param batch_size: amount of series windows processed in each training step.
+        :param ctx: MXNet context to train on, e.g. 'cpu', 'gpu' or 'gpu:1'. Defaults to CPU. Note that the trained network stays bound to this context, so a predictor trained on GPU can only be used on hosts with that GPU.
         """  # noqa
         super().__init__(stop_after)
         self.stable = True
@@ -62,12 +72,30 @@ class GluonTSMixer(BaseMixer):
         self.dtype_dict = dtype_dict
         self.ts_analysis = ts_analysis
         self.grouped_by = ['__default'] if not ts_analysis['tss'].group_by else ts_analysis['tss'].group_by
+
+        # static data preparation settings, reused by every `_make_initial_df` call
+        self._oby = ts_analysis['tss'].order_by
+        self._freq = ts_analysis['sample_freqs']['__default']
+        self._keep_cols = [f'__mdb_original_{self._oby}', self.target] + \
+            ([] if self.grouped_by == ['__default'] else self.grouped_by)
+        freq_offset = to_offset(self._freq)
+        try:
+            self._freq_ns = freq_offset.nanos
+        except ValueError:
+            self._freq_ns = None  # non-fixed frequency, e.g. months
+        # pandas closes (and labels) period-end frequencies on the right, see `pandas.core.resample.TimeGrouper`
+        end_types = {'M', 'A', 'Q', 'BM', 'BA', 'BQ', 'W'}
+        rule = freq_offset.rule_code
+        self._right_closed = rule in end_types or ('-' in rule and rule[:rule.find('-')] in end_types)
+
         self.groups = []  # list can grow using adjust() with new data
         self.estimator = None
         self.model = None
         self.train_cache = None
         self.patience = early_stop_patience
         self.seed = seed
+        self.batch_size = batch_size
+        self.ctx = ctx
 
         dist_module = importlib.import_module('.'.join(['gluonts.mx.distribution',
                                                         *distribution_output.split(".")[:-1]]))
@@ -92,7 +120,9 @@ class GluonTSMixer(BaseMixer):
             freq=train_ds.freq,
             prediction_length=self.horizon,
             distr_output=self.distribution,
-            trainer=Trainer(epochs=self.n_epochs, callbacks=[EarlyStop(patience=self.patience)])
+            batch_size=self.batch_size,
+            dtype=np.float32,
+            trainer=self._make_trainer()
         )
         self.model = self.estimator.train(train_ds)
         self.prepared = True
@@ -115,7 +145,7 @@ class GluonTSMixer(BaseMixer):
             self.n_epochs = args['n_epochs']
         if args.get('patience'):
             self.patience = args['patience']
-        self.estimator.trainer = Trainer(epochs=self.n_epochs, callbacks=[EarlyStop(patience=self.patience)])
+        self.estimator.trainer = self._make_trainer()
 
         # prepare data and fine-tune
         ds = ConcatedEncodedDs([train_data, dev_data])
@@ -129,83 +159,223 @@ class GluonTSMixer(BaseMixer):
         Calls the mixer to emit forecasts.
         """  # noqa
         length = sum(ds.encoded_ds_lenghts) if isinstance(ds, ConcatedEncodedDs) else len(ds)
-        ydf = pd.DataFrame(0,  # zero-filled
-                           index=np.arange(length),
-                           columns=['prediction', 'lower', 'upper'],
-                           dtype=object)
-        ydf['index'] = ds.data_frame.index
         conf = args.fixed_confidence if args.fixed_confidence else 0.9
-        ydf['confidence'] = conf
-
-        gby = self.ts_analysis["tss"].group_by if self.ts_analysis["tss"].group_by else []
-        groups = ds.data_frame[gby[0]].unique().tolist() if gby else None
-
-        for idx in range(length):
-            df = ds.data_frame.iloc[:idx] if idx != 0 else None
-            input_ds = self._make_initial_ds(df, groups=groups)
-            if not input_ds:
-                # edge case: new group
-                for col in ['prediction', 'lower', 'upper']:
-                    ydf.at[idx, col] = [0 for _ in range(self.ts_analysis["tss"].horizon)]
-            else:
-                mx.random.seed(self.seed)
-                np.random.seed(self.seed)
-                forecasts = list(self.model.predict(input_ds))[0]
-                ydf.at[idx, 'prediction'] = [entry for entry in forecasts.quantile(0.5)]
-                ydf.at[idx, 'lower'] = [entry for entry in forecasts.quantile(1 - conf)]
-                ydf.at[idx, 'upper'] = [entry for entry in forecasts.quantile(conf)]
+
+        narrow_df = ds.data_frame[self._keep_cols]  # only these columns are ever read below
+        if self.grouped_by != ['__default']:
+            row_gids = narrow_df[self.grouped_by[0]].values
+            groups = pd.unique(row_gids).tolist()
+        else:
+            row_gids = np.full(length, '__default_group', dtype=object)
+            groups = None
+
+        # bin train cache + all rows once, instead of resampling `cache + rows[:idx]` for every row
+        cache = self._filter_cache(groups)
+        histories = self._make_histories(narrow_df, cache, row_gids)
+
+        # rows without history (edge case: new group) keep a zero-filled forecast
+        pred_buf = np.zeros((length, self.horizon), dtype=np.float32)
+        lower_buf = np.zeros((length, self.horizon), dtype=np.float32)
+        upper_buf = np.zeros((length, self.horizon), dtype=np.float32)
+
+        # histories for all rows are submitted as a single multi-series dataset, mostly as views on their group's
+        # resampled target array, so no pandas dataset has to be built per row
+        pred_idxs = [idx for idx, history in enumerate(histories) if history is not None]
+        if pred_idxs:
+            input_ds = ListDataset([{'start': histories[idx][0],
+                                     'target': histories[idx][1],
+                                     'item_id': f'{row_gids[idx]}__{idx}'}
+                                    for idx in pred_idxs],
+                                   freq=self._freq)
+            mx.random.seed(self.seed)
+            np.random.seed(self.seed)
+            samples = np.stack([forecast.samples for forecast in self.model.predict(input_ds)])
+
+            # samples are (rows, num_samples, horizon), so all quantiles are computed in a single pass. Nearest
+            # interpolation picks the same sample as `SampleForecast.quantile()`
+            quantiles = np.quantile(samples, [0.5, 1 - conf, conf], axis=1, **{_QUANTILE_KWARG: 'nearest'})
+            pred_buf[pred_idxs], lower_buf[pred_idxs], upper_buf[pred_idxs] = quantiles
+
+        # `tolist()` converts in C and yields plain lists of python floats, as other mixers emit
+        ydf = pd.DataFrame({'prediction': pred_buf.tolist(),
+                            'lower': lower_buf.tolist(),
+                            'upper': upper_buf.tolist(),
+                            'index': ds.data_frame.index,
+                            'confidence': conf},
+                           index=np.arange(length))
 
         return ydf
 
-    def _make_initial_ds(self, df=None, phase='predict', groups=None):
-        oby = self.ts_analysis["tss"].order_by
-        gby = self.ts_analysis["tss"].group_by if self.ts_analysis["tss"].group_by else []
-        freq = self.ts_analysis['sample_freqs']['__default']
-        keep_cols = [f'__mdb_original_{oby}', self.target] + [col for col in gby]
+    def _make_trainer(self) -> Trainer:
+        return Trainer(ctx=self._get_context(), epochs=self.n_epochs, callbacks=[EarlyStop(patience=self.patience)])
+
+    def _get_context(self) -> mx.Context:
+        # GPU training is opt-in, as the predictor would otherwise not be usable on CPU-only hosts
+        if not self.ctx:
+            return mx.cpu()
+
+        device_type, _, device_id = self.ctx.partition(':')
+        if device_id:
+            return mx.Context(device_type, int(device_id))
+
+        # GluonTS trains on a single context, so multiple GPUs are shared across concurrent trainings instead
+        # (same policy as `lightwood.helpers.device.get_devices`)
+        n_gpus = mx.context.num_gpus() if device_type == 'gpu' else 0
+        if n_gpus > 1 and os.environ.get('RANDOM_GPU', False) in ['1', 'true', 'True', True, 1]:
+            return mx.gpu(randint(0, n_gpus - 1))
+        return mx.Context(device_type, 0)
 
-        if groups is None and gby:
+    def _make_initial_ds(self, df, phase='train', groups=None):
+        df = self._make_initial_df(df, phase=phase, groups=groups)
+        if df is None:
+            return None
+        ds = PandasDataset.from_long_dataframe(df, target=self.target, item_id=self._item_id_col(), freq=self._freq)
+        return ds
+
+    def _make_initial_df(self, df, phase='train', groups=None):
+        """
+        Concatenates incoming data with the train cache (if needed) and resamples it at the default sampling frequency.
+
+        :return: long dataframe with one resampled series per group, or `None` if there is no data.
+        """  # noqa
+        grouped = self.grouped_by != ['__default']
+
+        if groups is None and grouped:
             groups = self.groups
-        elif gby and phase in ('train', 'adjust') and self.grouped_by != ['__default']:
+        elif grouped and phase in ('train', 'adjust'):
             # we extend all seen groups for subsequent adjustments
             self.groups.extend(set(groups))
 
-        if df is None and phase not in ('train', 'adjust'):
-            df = self.train_cache
-            if gby:
-                df = df[df[gby[0]].isin(groups)]
-        else:
-            sub_df = df[keep_cols]
-            df = deepcopy(sub_df)
-
-            if phase == 'train':
-                self.train_cache = df.sort_index()
-            else:
-                if gby:
-                    cache = self.train_cache[self.train_cache[gby[0]].isin(groups)]
-                else:
-                    cache = self.train_cache
+        # column selection already yields a new frame, and it is never mutated in place afterwards
+        df = df[self._keep_cols].copy(deep=False)
 
-                if phase == 'adjust':
-                    # update cache to include all new information (pre-group filter)
-                    self.train_cache = pd.concat([self.train_cache, df]).drop_duplicates().sort_index()
+        if phase == 'train':
+            self.train_cache = df.sort_index()
+        else:
+            cache = self._filter_cache(groups)
+            if phase == 'adjust':
+                # update cache to include all new information (pre-group filter)
+                self.train_cache = self._concat_sorted(self.train_cache, df).drop_duplicates()
 
-                df = pd.concat([cache, df]).sort_index()
+            df = self._concat_sorted(cache, df)
 
         df = df.drop_duplicates()
 
         if len(df) == 0:
             return None
 
-        if gby:
-            df = df.groupby(by=gby[0]).resample(freq).sum().reset_index(level=[0])
+        if grouped:
+            gcol = self.grouped_by[0]
+            df = pd.concat([self._resample(sub_df).assign(**{gcol: gid}) for gid, sub_df in df.groupby(by=gcol)])
             # @TODO: multiple group support and remove groups without enough data
         else:
-            df = df.resample(freq).sum()
-            gby = '__default_group'
-            df[gby] = '__default_group'
+            df = self._resample(df)
+            df['__default_group'] = '__default_group'
 
-        ds = PandasDataset.from_long_dataframe(df, target=self.target, item_id=gby, freq=freq)
-        return ds
+        return df
+
+    def _resample(self, df: pd.DataFrame) -> pd.DataFrame:
+        """
+        Equivalent to `df[[self.target]].resample(self._freq).sum()`, but sums each period with `np.bincount` over the bins from `_bin()`.
+
+        Sums are accumulated in float64 but returned as float32, which is the precision DeepAR works with.
+        """  # noqa
+        labels, bins = self._bin(df.index)
+        target = np.nan_to_num(df[self.target].values.astype(float))  # resample().sum() skips missing values
+        sums = np.bincount(bins, weights=target, minlength=len(labels))
+        return pd.DataFrame({self.target: sums.astype(np.float32)}, index=labels)
+
+    def _bin(self, index: pd.DatetimeIndex) -> Tuple[pd.DatetimeIndex, np.ndarray]:
+        """
+        Assigns each timestamp to its `self._freq` period, exactly as `resample(self._freq)` would.
+
+        For fixed frequencies, bins are computed directly from the nanosecond timestamps, anchored at pandas' default 'start_day' origin. Otherwise, pandas provides the period labels and timestamps are mapped onto them on the same side that pandas closes its bins.
+
+        :return: labels of every period spanned by `index`, and the position of each timestamp within those labels.
+        """  # noqa
+        if self._freq_ns is not None and getattr(index, 'tz', None) is None:
+            timestamps = index.asi8
+            day_ns = pd.Timedelta(days=1).value
+            origin = timestamps.min() // day_ns * day_ns
+            bins = (timestamps - origin) // self._freq_ns
+            first_bin = bins.min()
+            start = pd.Timestamp(origin + first_bin * self._freq_ns)
+            labels = pd.date_range(start=start, periods=bins.max() - first_bin + 1, freq=self._freq)
+            return labels, bins - first_bin
+
+        labels = pd.Series(0, index=index).resample(self._freq).sum().index
+        if self._right_closed:
+            # labels are period ends, and a period covers its whole last day
+            return labels, labels.searchsorted(index.normalize(), side='left')
+        return labels, labels.searchsorted(index, side='right') - 1
+
+    @staticmethod
+    def _concat_sorted(cache: pd.DataFrame, df: pd.DataFrame) -> pd.DataFrame:
+        """ Appends `df` to the (already sorted) `cache`, only sorting the result when `df` does not come after it. """  # noqa
+        if df.index.is_monotonic_increasing and (len(cache) == 0 or len(df) == 0 or df.index[0] >= cache.index[-1]):
+            return pd.concat([cache, df])
+        return pd.concat([cache, df]).sort_index(kind='mergesort')
+
+    def _filter_cache(self, groups=None) -> pd.DataFrame:
+        """ Returns the subset of the train cache that belongs to `groups`. """  # noqa
+        if self.grouped_by == ['__default']:
+            return self.train_cache
+        groups = groups if groups is not None else self.groups
+        return self.train_cache[self.train_cache[self.grouped_by[0]].isin(groups)]
+
+    def _item_id_col(self) -> str:
+        return self.grouped_by[0] if self.grouped_by != ['__default'] else '__default_group'
+
+    def _make_histories(self, df: pd.DataFrame, cache: pd.DataFrame,
+                        row_gids: np.ndarray) -> List[Optional[Tuple[pd.Timestamp, np.ndarray]]]:
+        """
+        Builds the resampled target history that each row is forecasted from, i.e. the same series that resampling the group's train cache plus `df.iloc[:idx]` would yield.
+
+        Each group is binned once, and observations are added to the period sums in row order. A row gets a view on its group's final sums unless a later row still contributes to one of its periods, in which case the (partial) sums seen so far are copied.
+
+        :return: for each row, the start timestamp and target values of its history, or `None` if there is no history (edge case: new group).
+        """  # noqa
+        histories = [None] * len(row_gids)
+        if self.grouped_by != ['__default']:
+            cache_gids = cache[self.grouped_by[0]].values
+        else:
+            cache_gids = np.full(len(cache), '__default_group', dtype=object)
+        cache_positions = pd.Series(cache_gids).groupby(cache_gids).indices
+
+        for gid, positions in pd.Series(row_gids).groupby(row_gids).indices.items():
+            group_cache = cache.iloc[cache_positions.get(gid, np.array([], dtype=int))]
+            n_cache = len(group_cache)
+            obs = pd.concat([group_cache, df.iloc[positions]])
+
+            # duplicated observations are dropped, as in `_make_initial_df`
+            kept = ~obs.duplicated().values
+            bins = np.full(len(obs), -1)
+            labels, bins[kept] = self._bin(obs.index[kept])
+            values = np.nan_to_num(obs[self.target].values.astype(float))
+            cache_bins, row_bins = bins[:n_cache][kept[:n_cache]], bins[n_cache:]
+            row_values = values[n_cache:]
+
+            sums = np.bincount(cache_bins, weights=values[:n_cache][kept[:n_cache]], minlength=len(labels))
+            lo, hi = (cache_bins.min(), cache_bins.max() + 1) if len(cache_bins) else (len(labels), 0)
+
+            # earliest period that each row or any later one contributes to
+            future_bins = np.minimum.accumulate(np.where(row_bins >= 0, row_bins, len(labels))[::-1])[::-1]
+            complete = []
+            for k, position in enumerate(positions):
+                if hi > lo:
+                    if future_bins[k] >= hi:
+                        complete.append((position, lo, hi))
+                    else:
+                        histories[position] = (labels[lo], sums[lo:hi].astype(np.float32))
+                if row_bins[k] >= 0:
+                    sums[row_bins[k]] += row_values[k]
+                    lo, hi = min(lo, row_bins[k]), max(hi, row_bins[k] + 1)
+
+            sums = sums.astype(np.float32)
+            for position, lo, hi in complete:
+                histories[position] = (labels[lo], sums[lo:hi])
+
+        return histories
 
 
 class EarlyStop(TrainingHistory):
@@ -213,6 +383,8 @@ class EarlyStop(TrainingHistory):
         super().__init__()
         self.patience = max(1, patience)
         self.counter = 0
+        self.best = float('inf')
+        self.min_delta = 1e-6
 
     def on_validation_epoch_end(
         self,
@@ -223,13 +395,11 @@ class EarlyStop(TrainingHistory):
     ) -> bool:
         super().on_validation_epoch_end(epoch_no, epoch_loss, training_network, trainer)
 
-        if len(self.validation_loss_history) > 1:
-            if self.validation_loss_history[-1] > self.validation_loss_history[-2]:
-                self.counter += 1
-            else:
-                self.counter = 0  # reset if not successive
-
-        if self.counter >= self.patience:
-            return False
+        # compare against the best loss so far, so that plateaus also count towards the patience
+        if epoch_loss < self.best - self.min_delta:
+            self.best = epoch_loss
+            self.counter = 0
         else:
-            return True
+            self.counter += 1
+
+        return self.counter < self.patience
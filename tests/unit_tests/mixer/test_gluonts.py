@@ -0,0 +1,117 @@
+import unittest
+
+import numpy as np
+import pandas as pd
+
+from lightwood.api.types import TimeseriesSettings
+from lightwood.mixer.gluonts import GluonTSMixer, EarlyStop
+
+
+def get_mixer(freq, group_by=None):
+    tss = TimeseriesSettings(is_timeseries=True, order_by='T', window=3, horizon=2, group_by=group_by)
+    return GluonTSMixer(stop_after=1, target='y', horizon=2, window=3, dtype_dict={},
+                        ts_analysis={'tss': tss, 'sample_freqs': {'__default': freq}})
+
+
+def make_frame(timestamps, values, groups=None):
+    index = pd.DatetimeIndex(timestamps)
+    df = pd.DataFrame({'__mdb_original_T': index.asi8 // 10 ** 9, 'y': values}, index=index)
+    if groups is not None:
+        df['G'] = groups
+    return df
+
+
+class TestGluonTSHistories(unittest.TestCase):
+    def check_histories(self, freq, cache_ts, row_ts, grouped):
+        """ Each row's history must match the per-row resample of `cache + rows[:idx]` for the row's group """  # noqa
+        rng = np.random.RandomState(0)
+        cache_groups = ['a', 'b'] if grouped else [None]
+        row_groups = ['a', 'b', 'c'] if grouped else [None]  # 'c' has no cached history
+
+        cache = pd.concat([make_frame(cache_ts, rng.rand(len(cache_ts)) * 100, groups=g) for g in cache_groups])
+        cache = cache.sort_index(kind='mergesort')
+        rows = pd.concat([make_frame([ts], [rng.rand() * 100], groups=g) for ts in row_ts for g in row_groups])
+        rows.iloc[2, rows.columns.get_loc('y')] = np.nan
+        rows = pd.concat([cache.iloc[[-1]], rows])  # duplicate of a cached row
+
+        mixer = get_mixer(freq, group_by=['G'] if grouped else None)
+        mixer.train_cache = cache
+        row_gids = rows['G'].values if grouped else np.full(len(rows), '__default_group', dtype=object)
+        histories = mixer._make_histories(rows, mixer._filter_cache(pd.unique(row_gids).tolist()), row_gids)
+
+        self.assertEqual(len(histories), len(rows))
+        for idx in range(len(rows)):
+            expected = pd.concat([cache, rows.iloc[:idx]]).sort_index().drop_duplicates()
+            if grouped:
+                expected = expected[expected['G'] == row_gids[idx]]
+
+            if len(expected) == 0:
+                self.assertIsNone(histories[idx])
+                continue
+
+            expected = expected[['y']].resample(freq).sum()['y']
+            start, target = histories[idx]
+            self.assertEqual(start, expected.index[0])
+            np.testing.assert_allclose(target, expected.values, rtol=1e-5)
+
+    def test_daily(self):
+        # several observations per day, so rows share their last period with earlier and later rows
+        cache_ts = pd.date_range('2021-01-01 05:00', periods=10, freq='7H')
+        last = cache_ts[-1]
+        row_ts = [last + pd.Timedelta(hours=h) for h in (2, 5, 5, 30, 31, 80)]
+        for grouped in (False, True):
+            with self.subTest(grouped=grouped):
+                self.check_histories('D', cache_ts, row_ts, grouped)
+
+    def test_quarterly(self):
+        # quarter start timestamps, as in `tests/data/arrivals.csv`, while 'Q' periods are labelled by their end
+        cache_ts = pd.date_range('1981-01-01', periods=12, freq='QS')
+        row_ts = pd.to_datetime(['1984-01-01', '1984-02-15', '1984-04-01', '1984-10-01', '1985-01-01'])
+        for grouped in (False, True):
+            with self.subTest(grouped=grouped):
+                self.check_histories('Q', cache_ts, row_ts, grouped)
+
+
+class TestGluonTSResample(unittest.TestCase):
+    def test_matches_pandas(self):
+        """ `_resample` must bin and sum exactly as `resample(freq).sum()` does """  # noqa
+        steps = {'H': pd.Timedelta(hours=1), 'D': pd.Timedelta(days=1), '2D': pd.Timedelta(days=2),
+                 'T': pd.Timedelta(minutes=1), 'W': pd.Timedelta(days=7), 'M': pd.Timedelta(days=30),
+                 'Q': pd.Timedelta(days=91)}
+        rng = np.random.RandomState(0)
+        for freq, step in steps.items():
+            for start in ('2021-03-01 00:00', '2021-03-01 05:17'):  # at and off midnight
+                with self.subTest(freq=freq, start=start):
+                    # zero deltas yield duplicate timestamps, the rest irregular gaps (some spanning empty periods)
+                    deltas = rng.choice([0, 0.3, 1, 2.5, 7], size=40)
+                    offsets = pd.to_timedelta((np.cumsum(deltas) * step.value).astype(np.int64), unit='ns')
+                    values = rng.rand(40) * 10
+                    values[[3, 17]] = np.nan
+                    df = pd.DataFrame({'y': values}, index=pd.Timestamp(start) + offsets)
+
+                    expected = df[['y']].resample(freq).sum()
+                    result = get_mixer(freq)._resample(df)
+                    np.testing.assert_array_equal(result.index.asi8, expected.index.asi8)
+                    np.testing.assert_allclose(result['y'].values, expected['y'].values, rtol=1e-5)
+
+
+class TestGluonTSEarlyStop(unittest.TestCase):
+    def stop_epoch(self, losses, patience):
+        callback = EarlyStop(patience=patience)
+        for epoch, loss in enumerate(losses):
+            if not callback.on_validation_epoch_end(epoch, loss, None, None):
+                return epoch
+        return None
+
+    def test_improvement(self):
+        self.assertIsNone(self.stop_epoch([1.0, 0.9, 0.8, 0.7], patience=1))
+
+    def test_plateau(self):
+        self.assertEqual(self.stop_epoch([1.0, 0.8, 0.8, 0.8, 0.8], patience=2), 3)
+
+    def test_oscillation(self):
+        # never beats the best loss again, even though epoch 3 improves on epoch 2
+        self.assertEqual(self.stop_epoch([1.0, 0.9, 0.95, 0.91, 0.92, 0.5], patience=3), 4)
+
+    def test_reset(self):
+        self.assertEqual(self.stop_epoch([1.0, 1.0, 0.5, 0.5, 0.5], patience=2), 4)